@@ -3,10 +3,35 @@ import subprocess
 import re
 import csv
 import sys
+import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from difflib import SequenceMatcher
 
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # ohne rapidfuzz: langsamer Fallback über difflib
+    fuzz = process = None
+
+try:
+    import numpy  # für rapidfuzz.process.cdist
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:  # ohne orjson: Standardbibliothek
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:  # ohne pyahocorasick: Regeln einzeln durchsuchen
+    ahocorasick = None
+
 
 DATE_RE = re.compile(r"^\d{2}\.\d{2}\.\d{4}")
 AMOUNT_RE = re.compile(r"-?\d{1,3}(?:\.\d{3})*,\d{2}")
@@ -14,44 +39,162 @@ END_MARKER_RE = re.compile(
     r"(Kontostand am \d{2}\.\d{2}\.\d{4} um \d{2}\:\d{2} Uhr|Gesamtumsatzsummen Summe Soll EUR)",
     re.IGNORECASE
 )
-
-def fuzzy_score(a, b):
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+# 1.234,56 → 1234.56
+AMOUNT_TRANS = str.maketrans({".": "", ",": "."})
+# führende Satzzeichen + Leerzeichen in Beschreibungen
+DESCRIPTION_STRIP_CHARS = " ,.;:-/)_"
+
+
+@dataclass(slots=True)
+class Booking:
+    # feste Felder statt dict pro Buchung
+    Datum: str = ""
+    Buchungsart: str = ""
+    Textblock: str = ""
+    Soll: str = ""
+    Haben: str = ""
+    Name: str = ""
+    Beschreibung: str = ""
+    Quelle: str = ""
+
+
+def _ratio(a, b, cutoff=0.0):
+    # difflib-Fallback ohne rapidfuzz; erwartet kleingeschriebene Texte,
+    # unter cutoff → 0.0
+    if a == b:
+        return 1.0
+    # ratio() ≤ 2·min/(|a|+|b|): zu unterschiedliche Längen gar nicht vergleichen
+    if 2 * min(len(a), len(b)) < cutoff * (len(a) + len(b)):
+        return 0.0
+    matcher = SequenceMatcher(None, a, b)
+    # obere Schranke über Zeichenhäufigkeiten, spart oft das teure ratio()
+    if matcher.quick_ratio() < cutoff:
+        return 0.0
+    score = matcher.ratio()
+    return score if score >= cutoff else 0.0
 
 def get_fuzzy_declarations(text, threshold, limit):
-    names = load_declarations()
+    names, names_lower = load_declarations_index()
+    text_lower = text.lower()
+
+    if process:
+        # Bewertung und Top-k in einem Aufruf
+        matches = process.extract(
+            text_lower,
+            names_lower,
+            scorer=fuzz.ratio,
+            score_cutoff=threshold * 100,
+            limit=limit,
+        )
+        return [(names[idx], score / 100.0) for _, score, idx in matches]
+
     scored = []
 
-    for key in names:
-        score = fuzzy_score(text, key)
+    for key, key_lower in zip(names, names_lower):
+        score = _ratio(text_lower, key_lower, threshold)
         if score >= threshold:
             scored.append((key, score))
 
     scored.sort(key=lambda x: x[1], reverse=True)
     return scored[:limit]
 
+def _partial_match(name, text):
+    # Name gegen das ähnlichste gleich lange Textstück (partial_ratio);
+    # liefert (Score, Ende des Textstücks), erwartet kleingeschriebene Texte
+    if fuzz:
+        match = fuzz.partial_ratio_alignment(name, text)
+        return match.score / 100.0, match.dest_end
+    if len(name) >= len(text):
+        return SequenceMatcher(None, name, text).ratio(), len(text)
+    best = (0.0, 0)
+    for a, b, _ in SequenceMatcher(None, name, text).get_matching_blocks():
+        start = max(b - a, 0)
+        window = text[start:start + len(name)]
+        score = SequenceMatcher(None, name, window).ratio()
+        if score > best[0]:
+            best = (score, start + len(window))
+    return best
+
+def batch_match(texts, threshold, limit):
+    # Deklarationen als Teilstück der Texte suchen, für viele Texte auf einmal;
+    # ein ganzer Textblock ist viel länger als ein Name, ratio() passt nie
+    names, names_lower = load_declarations_index()
+    texts_lower = [text.lower() for text in texts]
+    if not names:
+        return [[] for _ in texts]
+
+    rows = []
+    if process and numpy:
+        # komplette Texte × Namen-Matrix in einem Aufruf, auf allen Kernen
+        matrix = process.cdist(
+            texts_lower,
+            names_lower,
+            scorer=fuzz.partial_ratio,
+            score_cutoff=threshold * 100,
+            dtype=numpy.float64,
+            workers=-1,
+        ) / 100.0
+        for row in matrix:
+            rows.append((row, (-row).argsort(kind="stable")[:limit]))
+    else:
+        for text_lower in texts_lower:
+            row = [_partial_match(name, text_lower)[0] for name in names_lower]
+            rows.append((row, sorted(range(len(row)), key=lambda idx: -row[idx])[:limit]))
+
+    return [
+        [(names[idx], float(row[idx])) for idx in best if row[idx] >= threshold]
+        for row, best in rows
+    ]
+
 def clean_description(text):
     if not text:
         return ""
-    # führende Satzzeichen + Leerzeichen entfernen
-    return text.lstrip(" ,.;:-/)_")
+    # str.lstrip ist bereits C-Code und schneller als ein Regex-sub
+    return text.lstrip(DESCRIPTION_STRIP_CHARS)
+
+def _file_stamp(path):
+    # ändert sich bei jedem Schreiben → Cache wird automatisch ungültig
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+@lru_cache(maxsize=8)
+def _read_json(path, stamp):
+    if orjson:
+        return orjson.loads(Path(path).read_bytes())
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _cached_json(path):
+    return _read_json(str(path), _file_stamp(path))
 
 def load_reference_db(path="references.json"):
-    if not Path(path).exists():
+    # Achtung: gecachtes Objekt, nicht verändern
+    try:
+        return _cached_json(path)
+    except FileNotFoundError:
         return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+
+@lru_cache(maxsize=8)
+def _declarations(path, stamp):
+    db = _read_json(path, stamp)
+    # eindeutige Anzeigenamen, alphabetisch, dazu einmalig kleingeschrieben
+    names = tuple(sorted(set(db.values())))
+    return names, tuple(name.lower() for name in names)
+
+def load_declarations_index(path="split_rules.json"):
+    try:
+        return _declarations(str(path), _file_stamp(path))
+    except FileNotFoundError:
+        return (), ()
 
 def load_declarations(path="split_rules.json"):
-    db = load_reference_db(path)
-    # eindeutige Anzeigenamen, alphabetisch
-    names = sorted(set(db.values()))
-    return names
+    return load_declarations_index(path)[0]
 
 def ask_user_select_declaration(text):
-    while True:
-        fuzzy = get_fuzzy_declarations(text, 0.4, 10)
+    # ändert sich bei ungültiger Eingabe nicht → nur einmal berechnen
+    fuzzy = get_fuzzy_declarations(text, 0.4, 10)
 
+    while True:
         if fuzzy:
             print("\n🔎 Ähnliche Deklarationen:")
             for i, (name, score) in enumerate(fuzzy, 1):
@@ -98,24 +241,31 @@ def ask_user_select_declaration(text):
     print("⚠️ Ungültige Auswahl")
 
 def save_reference(key, value, path="references.json"):
-    db = load_reference_db(path)
+    db = dict(load_reference_db(path))
     db[key] = value
+    if orjson:
+        Path(path).write_bytes(orjson.dumps(db, option=orjson.OPT_INDENT_2))
+        return
     with open(path, "w", encoding="utf-8") as f:
         json.dump(db, f, indent=2, ensure_ascii=False)
 
 def pdf_to_text(pdf_path):
-    result = subprocess.run(
+    # zeilenweise aus der Pipe lesen, während pdftotext noch arbeitet
+    with subprocess.Popen(
         ["pdftotext", "-layout", pdf_path, "-"],
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
         text=True,
-    )
-    return result.stdout.splitlines()
+        bufsize=1 << 16,
+    ) as proc:
+        for line in proc.stdout:
+            # Seitenende \f wie früher bei splitlines() als eigene Leerzeile
+            yield from line.splitlines()
 
 def normalize_amount(val):
     if not val:
         return ""
-    return val.replace(".", "").replace(",", ".")
+    return val.translate(AMOUNT_TRANS)
 
 def show_split_preview(text, idx):
     left = text[:idx]
@@ -124,93 +274,126 @@ def show_split_preview(text, idx):
     print(f"[{left}] | [{right}]")
 
 def format_amount(b):
-    if b.get("Soll"):
-        return f"-{b['Soll']} EUR"
-    if b.get("Haben"):
-        return f"+{b['Haben']} EUR"
+    if b.Soll:
+        return f"-{b.Soll} EUR"
+    if b.Haben:
+        return f"+{b.Haben} EUR"
     return "0,00 EUR"
 
 
 def parse_lines(lines):
     bookings = []
     current = None
+    parts = []  # Textblock-Zeilen, erst beim Abschluss verbunden
     seen_description = False
+    # globale/Attribut-Lookups einmal statt pro Zeile
+    date_match = DATE_RE.match
+    end_search = END_MARKER_RE.search
+    add_booking = bookings.append
 
     for line in lines:
         line = line.rstrip()
-        datecheck = line[:15].strip()
-        # Neue Buchung
-        if DATE_RE.match(datecheck):
+        head = line[:15].lstrip()
+        # Neue Buchung; billige Vorprüfung auf TT.MM. erspart fast allen
+        # anderen Zeilen den Regex
+        if len(head) >= 10 and head[2] == "." and head[5] == "." and date_match(head):
             if current:
-                bookings.append(current)
+                current.Textblock = " ".join(parts)
+                add_booking(current)
 
+            parts = []
             seen_description = False
             line = line.strip()
             date = line[:10]
             line = line[10:].strip()
 
-            current = {
-                "Datum": date,
-                "Buchungsart": "",
-                "Textblock": "",
-                "Soll": "",
-                "Haben": "",
-                }
+            current = Booking(Datum=date)
             
             # Betrag extrahieren
             amounts = AMOUNT_RE.findall(line)
             if amounts:
                 amount = normalize_amount(amounts[-1])
                 if "-" in amounts[-1]:
-                    current["Soll"] = amount
+                    current.Soll = amount
                 else:
-                    current["Haben"] = amount
+                    current.Haben = amount
 
             line = line[:40].strip()
-            current["Buchungsart"] = line
+            current.Buchungsart = line
 
 
         # Folgezeilen
         elif current:
-            if END_MARKER_RE.search(line):
-                bookings.append(current)
+            if end_search(line):
+                current.Textblock = " ".join(parts)
+                add_booking(current)
                 current = None
                 break
 
             clean = line.strip()
             if len(clean) < 2:
-                bookings.append(current)
+                current.Textblock = " ".join(parts)
+                add_booking(current)
                 current = None
 
             # 👇 alles in EIN Feld
-            elif current["Textblock"]:
-                current["Textblock"] += " " + clean
             else:
-                current["Textblock"] = clean
+                parts.append(clean)
 
 
     if current:
-        bookings.append(current)
+        current.Textblock = " ".join(parts)
+        add_booking(current)
 
     return bookings
 
+@lru_cache(maxsize=8)
+def _split_automaton(path, stamp):
+    automaton = ahocorasick.Automaton()
+    for order, (key, value) in enumerate(_read_json(path, stamp).items()):
+        automaton.add_word(key, (order, key, value))
+    automaton.make_automaton()
+    return automaton
+
+def load_split_rules(path="split_rules.json"):
+    try:
+        stamp = _file_stamp(path)
+        rules = _read_json(str(path), stamp)
+    except FileNotFoundError:
+        return {}
+    # leere Schlüssel kann der Automat nicht aufnehmen → dict-Suche
+    if ahocorasick and rules and "" not in rules:
+        # alle Schlüssel in einem Automaten, nur bei Dateiänderung neu gebaut
+        return _split_automaton(str(path), stamp)
+    return rules
+
 def apply_split_rule(text, rules):
+    if ahocorasick and isinstance(rules, ahocorasick.Automaton):
+        # ein Durchlauf über den Text; erste Regel in Dateireihenfolge gewinnt
+        hits = [match for _, match in rules.iter(text)]
+        if not hits:
+            return None, None
+        _, key, value = min(hits)
+        return value, text[len(key):].strip()
+
     for key, value in rules.items():
         if key in text:
             return value, text[len(key):].strip()
     return None, None
 
 def ask_user_for_split(b):
-    text = b["Textblock"].strip()
+    text = b.Textblock.strip()
     print("\n❓ Unklare Buchung:")
     print("=" * 60)
-    print(f"📄 Datei: {b.get('Quelle', 'unbekannt')}")
-    print(f"📅 Datum: {b.get('Datum', '')}")
+    print(f"📄 Datei: {b.Quelle or 'unbekannt'}")
+    print(f"📅 Datum: {b.Datum}")
     print(f"💶 Betrag: {format_amount(b)}")
     print("-" * 60)
     print(text)
     print("=" * 60)
 
+    text_lower = text.lower()
+
     while True:
         marker = input(
             "👉 Letzte Zeichen/Ziffern des Namens eingeben: "
@@ -219,7 +402,6 @@ def ask_user_for_split(b):
         if not marker:
             return None, None, None
 
-        text_lower = text.lower()
         marker_lower = marker.lower()
 
         idx = text_lower.rfind(marker_lower)
@@ -252,6 +434,11 @@ def ask_user_for_split(b):
     rest = text[split_idx:].strip()
     key = text[:split_idx].strip()
 
+    # leerer Schlüssel würde als Regel auf jede Buchung passen
+    if not key:
+        print("⚠️ Kein Name vor der Trennung, Buchung wird übersprungen")
+        return None, None, None
+
     selected = ask_user_select_declaration(key)
     if selected:
         return selected, rest, key
@@ -263,30 +450,50 @@ def ask_user_for_split(b):
     return name, rest, key
 
 
-def enrich_bookings(bookings, interactive=True):
+def enrich_bookings(bookings, interactive=True, auto_match=False):
+    rules = load_split_rules("split_rules.json")
+    unmatched = []
+
     for b in bookings:
-        rules = load_reference_db("split_rules.json")
-        text = b["Textblock"].strip()
+        text = b.Textblock.strip()
 
         label, rest = apply_split_rule(text, rules)
         if label:
-            b["Name"] = label
-            b["Beschreibung"] = clean_description(rest)
+            b.Name = label
+            b.Beschreibung = clean_description(rest)
             continue
 
         if interactive:
             print("\n" + "=" * 60)
-            print(f"📄 Aktive Datei: {b.get('Quelle', 'unbekannt')}")
+            print(f"📄 Aktive Datei: {b.Quelle or 'unbekannt'}")
             print("=" * 60)
             name, rest, key = ask_user_for_split(b)
             if name:
-                b["Name"] = key
-                b["Beschreibung"] = clean_description(rest)
+                b.Name = key
+                b.Beschreibung = clean_description(rest)
                 save_reference(key, name, "split_rules.json")
+                rules = load_split_rules("split_rules.json")
             else:
-                b["Name"] = text
-                b["Beschreibung"] = ""
-
+                b.Name = text
+                b.Beschreibung = ""
+        elif auto_match:
+            unmatched.append(b)
+
+    # ohne Rückfragen: Deklaration im Text suchen, Rest als Beschreibung;
+    # hohe Schwelle, weil niemand die Zuordnung bestätigt
+    if unmatched:
+        print(f"\n🤖 Automatische Zuordnung für {len(unmatched)} Buchungen ohne Regel:")
+        texts = [b.Textblock.strip() for b in unmatched]
+        for b, text, fuzzy in zip(unmatched, texts, batch_match(texts, 0.9, 1)):
+            if not fuzzy:
+                print(f"❔ {b.Datum} {text[:50]} → keine passende Deklaration")
+                continue
+
+            name, score = fuzzy[0]
+            _, end = _partial_match(name.lower(), text.lower())
+            b.Name = name
+            b.Beschreibung = clean_description(text[end:])
+            print(f"✔ {b.Datum} {text[:50]} → {name} ({int(score * 100)}%)")
 
     return bookings
 
@@ -303,52 +510,69 @@ def write_csv(bookings, out_path):
             "Quelldatei",
         ])
 
-        for b in bookings:
-            writer.writerow([
-                b["Datum"],
-                b["Buchungsart"],
-                b.get("Name", "").strip(),
-                b.get("Beschreibung", "").strip(),
-                b["Soll"],
-                b["Haben"],
-                b["Quelle"],
-            ])
+        writer.writerows(
+            (
+                b.Datum,
+                b.Buchungsart,
+                b.Name.strip(),
+                b.Beschreibung.strip(),
+                b.Soll,
+                b.Haben,
+                b.Quelle,
+            )
+            for b in bookings
+        )
+
+def _process_pdf(pdf):
+    # closing() beendet pdftotext sofort, auch wenn parse_lines früher aufhört
+    with closing(pdf_to_text(str(pdf))) as lines:
+        bookings = parse_lines(lines)
+
+    for b in bookings:
+        b.Quelle = pdf.name
+
+    return bookings
 
 def process_folder(folder_path):
     all_bookings = []
+    pdfs = sorted(Path(folder_path).glob("*.pdf"))
 
-    for pdf in sorted(Path(folder_path).glob("*.pdf")):
-        print(f"→ Verarbeite {pdf.name}")
-        lines = pdf_to_text(str(pdf))
-        bookings = parse_lines(lines)
-
-        for b in bookings:
-            b["Quelle"] = pdf.name
+    # pdftotext läuft als eigener Prozess → Threads reichen für Parallelität
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = []
+        for pdf in pdfs:
+            print(f"→ Verarbeite {pdf.name}")
+            futures.append(ex.submit(_process_pdf, pdf))
 
-        all_bookings.extend(bookings)
+        # Ergebnisse in Dateireihenfolge einsammeln
+        for future in futures:
+            all_bookings.extend(future.result())
 
     return all_bookings
 
 def main():
-    if len(sys.argv) != 3:
+    args = sys.argv[1:]
+    auto = "--auto" in args
+    if auto:
+        args.remove("--auto")
+
+    if len(args) != 2:
         print("Usage:")
         print("  Einzeldatei: dkb_pdf_to_csv.py input.pdf output.csv")
         print("  Ordner:      dkb_pdf_to_csv.py pdf_ordner/ output.csv")
+        print("  Ohne Rückfragen (ähnlichste Deklaration): --auto anhängen")
         sys.exit(1)
 
-    input_path = Path(sys.argv[1])
-    output_csv = sys.argv[2]
+    input_path = Path(args[0])
+    output_csv = args[1]
 
     if input_path.is_dir():
         bookings = process_folder(input_path)
-        bookings = enrich_bookings(bookings, interactive=True)
+        bookings = enrich_bookings(bookings, interactive=not auto, auto_match=auto)
 
     elif input_path.is_file():
-        lines = pdf_to_text(str(input_path))
-        bookings = parse_lines(lines)
-        bookings = enrich_bookings(bookings, interactive=True)
-        for b in bookings:
-            b["Quelle"] = input_path.name
+        bookings = _process_pdf(input_path)
+        bookings = enrich_bookings(bookings, interactive=not auto, auto_match=auto)
     else:
         print("❌ Ungültiger Eingabepfad")
         sys.exit(1)